@@ -1,108 +1,366 @@
 import streamlit as st
 import ebooklib
 from ebooklib import epub
-from bs4 import BeautifulSoup, NavigableString, Tag
-import tempfile
-import os
-import nltk
-nltk.download('punkt')
-nltk.download('punkt_tab')
+import lxml.etree
+import lxml.html
+import io
+import logging
+import html
+import re
+import itertools
+import urllib.parse
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# EPUB content documents are UTF-8 encoded XHTML; tell libxml2 rather than letting it guess
+HTML_PARSER = lxml.html.HTMLParser(encoding='utf-8')
+
+# First <h1>, <h2>, <h3> or <title> tag in document order, with its inner HTML (None if self-closing)
+TITLE_RE = re.compile(rb'<(h[1-3]|title)\b[^>]*?(?:/>|>(.*?)</\1\s*>)', re.IGNORECASE | re.DOTALL)
+TAG_RE = re.compile(r'<[^>]*>')
+
+# Sentence boundaries: whitespace after terminal punctuation, or after a closing quote or bracket
+# that follows it, when the next sentence does not start in lowercase ("Run!" she said.). No split
+# after titles and reference abbreviations (Mr., Fig. 3, e.g.), acronyms (U.S.) or within a run of
+# initials (J. R. R. Tolkien); the abbreviations are grouped by length as lookbehinds are fixed width.
+# A lone capital is only treated as an initial next to another one, so that "Plan B. It" and "I. Then"
+# split; the cost is that a single middle initial splits too ("John F. | Kennedy")
+SENTENCE_BOUNDARY_RE = re.compile(
+    r'(?<!\bp\.)(?<!\b(?:Mr|Ms|Dr|St|Jr|Sr|Mt|Lt|No|pp|cf|vs)\.)'
+    r'(?<!\b(?:Mrs|Fig|Vol|Nos|Sec|Gen|Col|Rev|Sgt|etc)\.)(?<!\b(?:Prof|Capt|Figs|Vols)\.)'
+    r'(?<!\b(?:e\.g|i\.e)\.)'
+    r'(?<![A-Z]\.[A-Z]\.)(?<!\b[A-Z]\.\s[A-Z]\.)(?!(?<=\b[A-Z]\.)\s+[A-Z]\.(?:\s|$))'
+    r'(?:(?<=[.!?])|(?<=[.!?]["\'\u201d\u2019)\]]))\s+(?=[^\sa-z])'
+)
+
+# Tags that map directly onto a single content unit type
+TAG_UNIT_TYPES = {
+    'h1': 'heading', 'h2': 'heading', 'h3': 'heading',
+    'h4': 'heading', 'h5': 'heading', 'h6': 'heading',
+    'ul': 'list', 'ol': 'list',
+    'img': 'image',
+}
+
+# Unit types that may sit between a paragraph and its headings, and the types that end the
+# content following a paragraph
+LEADING_UNIT_TYPES = frozenset({'heading', 'image', 'caption', 'spacer'})
+SECTION_UNIT_TYPES = frozenset({'paragraph', 'heading'})
+
+# Highlight classes for the sentences of the current paragraph, cycling through the theme colors
+HIGHLIGHT_CLASSES = tuple(f"reader-hl reader-hl-{i}" for i in range(1, 6))
+SENTENCE_TEMPLATE = '<span class="{cls}">{text}</span>'
+
+# Styles of the reader. Streamlit drops elements that a full rerun does not write again,
+# so main() emits this on every rerun; Previous/Next only rerun the reader fragment.
+READER_CSS = """
+    <style>
+    :root {
+        /* Dark theme colors */
+        --color-1: #d32f2f;
+        --color-2: #1976d2;
+        --color-3: #388e3c;
+        --color-4: #512da8;
+        --color-5: #FBC02D;
+        --text-color: #FFFFFF;
+        --primary-color: #0E1117;
+    }
+
+    @media (prefers-color-scheme: light) {
+        :root {
+            /* Light theme colors */
+            --color-1: #ffd54f;
+            --color-2: #aed581;
+            --color-3: #64b5f6;
+            --color-4: #f06292;
+            --color-5: #FBC02D;
+            --text-color: #000000;
+            --primary-color: #FFFFFF;
+        }
+    }
+
+    /* Hide the Streamlit style elements (hamburger menu, header, footer) */
+    
+    header {visibility: hidden;}
+    footer {visibility: hidden;}
+
+    /* Content blocks of the reader */
+    .reader-block {
+        font-family: Georgia, serif;
+        font-weight: 450;
+        font-size: 20px;
+        color: var(--text-color);
+        line-height: 1.6;
+        max-width: 1000px;
+        margin: 10px auto;
+        padding: 15px;
+        border: 1px solid var(--primary-color);
+        transition: text-shadow 0.5s;
+    }
+
+    .reader-heading {
+        font-size: 28px;
+        font-weight: bold;
+        border: none;
+        padding-top: 30px;
+    }
+
+    .reader-caption {
+        font-size: 18px;
+        font-style: italic;
+        border: none;
+    }
+
+    .reader-list {
+        padding-left: 40px;
+        list-style-type: disc;
+        border: none;
+    }
+
+    .reader-image {
+        display: flex;
+        justify-content: center;
+        margin: 20px 0;
+    }
 
-from nltk.tokenize import sent_tokenize
+    /* Highlighted sentences of the current paragraph */
+    .reader-hl {
+        padding: 2px 5px;
+        border-radius: 5px;
+        color: var(--text-color);
+    }
+
+    .reader-hl-1 { background-color: var(--color-1); }
+    .reader-hl-2 { background-color: var(--color-2); }
+    .reader-hl-3 { background-color: var(--color-3); }
+    .reader-hl-4 { background-color: var(--color-4); }
+    .reader-hl-5 { background-color: var(--color-5); }
+
+    /* Responsive font sizes for mobile devices */
+    @media only screen and (max-width: 600px) {
+        .reader-block {
+            font-size: 5vw !important;
+        }
+    }
+
+    ul, ol {
+        margin: 0;
+        padding-left: 1.5em;
+    }
+
+    li {
+        margin-bottom: 0.5em;
+    }
+    </style>
+    """
 
-def get_content_units(soup):
+@dataclass(slots=True)
+class ContentUnit:
     """
-    Processes the HTML content and returns a list of content units in the order they appear.
-    Each content unit is a dictionary with 'type' and 'content' keys.
+    A block of chapter content: its lxml element (None for stray text and spacers), the plain
+    text of paragraphs and stray strings, and the HTML that unit_html serializes on first use.
+    Units are shared through the parse_chapter cache; 'html' is the only field written after
+    parsing, and every writer stores the same string.
+    """
+    type: str
+    node: object = None
+    text: str = ''
+    html: str | None = None
+
+def get_content_units(root):
+    """
+    Processes the HTML content and returns a list of content units in the order they appear,
+    along with the indices of the paragraphs among them.
+    Each content unit is a ContentUnit holding its type, lxml element and plain text.
     """
     content_units = []
+    paragraph_indices = []
+
+    def process_text(text):
+        """Adds a text unit for a stray string between elements."""
+        # Ignore strings that are whitespace
+        if text and text.strip():
+            # Wrap the text in a paragraph unit if it's significant
+            content_units.append(ContentUnit('text', text=text))
 
     def process_element(element):
-        """Recursively process element and its children."""
-        if isinstance(element, NavigableString):
-            # Ignore strings that are whitespace
-            if element.strip():
-                # Wrap the text in a paragraph unit if it's significant
-                content_units.append({'type': 'text', 'content': str(element)})
-            return
-        elif isinstance(element, Tag):
-            # Process the element based on its tag
-            if element.name in ['h1', 'h2', 'h3', 'h4', 'h5', 'h6']:
-                # Heading
-                content_units.append({'type': 'heading', 'content': str(element)})
-            elif element.name == 'p':
-                p_class = element.get('class', [])
-                if not p_class:
-                    p_class = []
-                # Check if the paragraph is empty or a spacer
-                is_empty = not element.get_text(strip=True)
-                if is_empty or 'spaceBreak1' in p_class:
-                    # Spacer or empty paragraph
-                    content_units.append({'type': 'spacer', 'content': str(element)})
-                elif 'caption' in p_class:
-                    # Caption
-                    content_units.append({'type': 'caption', 'content': str(element)})
-                elif 'centerImage' in p_class:
-                    # Image (wrapped in a <p> tag)
-                    content_units.append({'type': 'image', 'content': str(element)})
-                elif 'chapterSubtitle' in p_class or 'chapterSubtitle1' in p_class or 'chapterOpenerText' in p_class:
-                    # Treat these as headings
-                    content_units.append({'type': 'heading', 'content': str(element)})
-                else:
-                    # Regular paragraph
-                    content_units.append({'type': 'paragraph', 'content': str(element)})
-            elif element.name in ['ul', 'ol']:
-                # List
-                content_units.append({'type': 'list', 'content': str(element)})
-            elif element.name == 'div':
-                # Process children of the div
-                for child in element.contents:
-                    process_element(child)
-            elif element.name == 'img':
-                # Image
-                content_units.append({'type': 'image', 'content': str(element)})
+        """Adds the content unit for an element, returning False for containers."""
+        name = element.tag
+
+        # Process the element based on its tag
+        unit_type = TAG_UNIT_TYPES.get(name)
+        if unit_type:
+            # Heading, list or image
+            content_units.append(ContentUnit(unit_type, element))
+        elif name == 'p':
+            p_class = element.get('class', '').split()
+            # Extract the plain text once; it also tells empty paragraphs apart
+            text = element.text_content().strip()
+            # Check if the paragraph is empty or a spacer
+            if not text or 'spaceBreak1' in p_class:
+                # Spacer or empty paragraph; never rendered, so the element is not kept
+                content_units.append(ContentUnit('spacer'))
+            elif 'caption' in p_class:
+                # Caption
+                content_units.append(ContentUnit('caption', element))
+            elif 'centerImage' in p_class:
+                # Image (wrapped in a <p> tag)
+                content_units.append(ContentUnit('image', element))
+            elif 'chapterSubtitle' in p_class or 'chapterSubtitle1' in p_class or 'chapterOpenerText' in p_class:
+                # Treat these as headings
+                content_units.append(ContentUnit('heading', element))
             else:
-                # Process children of other tags
-                for child in element.contents:
-                    process_element(child)
+                # Regular paragraph, recording its position as it is added
+                paragraph_indices.append(len(content_units))
+                content_units.append(ContentUnit('paragraph', element, text))
         else:
-            # Other element types
-            pass
+            # Divs and other container tags are descended into by the walk below
+            return False
+        return True
+
+    # Walk the body, or the root if body is not found, in document order without recursing.
+    # Each stack entry holds the remaining children of a container and the text following it.
+    body = root.find('body')
+    start = body if body is not None else root
+    process_text(start.text)
+    stack = [(iter(start), None)]
+    while stack:
+        children, tail = stack[-1]
+        element = next(children, None)
+        if element is None:
+            # The container is done; the text after it comes next
+            stack.pop()
+            process_text(tail)
+        # Skip comments and processing instructions, whose tag is not a string
+        elif isinstance(element.tag, str) and not process_element(element):
+            process_text(element.text)
+            stack.append((iter(element), element.tail))
+        else:
+            process_text(element.tail)
 
-    # Start processing from the body
-    body = soup.find('body')
-    if body:
-        for elem in body.contents:
-            process_element(elem)
-    else:
-        # Start from the root if body is not found
-        for elem in soup.contents:
-            process_element(elem)
+    return content_units, paragraph_indices
 
-    return content_units
+def unit_html(cu):
+    """
+    Returns the HTML of a content unit, serializing its element (without the text
+    that follows it) on first use.
+    """
+    if cu.html is None:
+        if cu.node is None:
+            # Stray text comes unescaped from the parser
+            cu.html = html.escape(cu.text)
+        else:
+            cu.html = lxml.html.tostring(cu.node, encoding='unicode', with_tail=False)
+    return cu.html
 
-def extract_chapter_title(item):
+@st.cache_resource(max_entries=32, show_spinner=False)
+def parse_chapter(book_id, chapter_index, _item):
+    """
+    Parses the HTML content of a chapter into content units and the indices of its paragraphs.
+    Cached per (book, chapter) as a resource, since the units keep their lxml elements.
+    """
+    try:
+        root = lxml.html.document_fromstring(_item.get_content(), parser=HTML_PARSER)
+    except lxml.etree.ParserError:
+        # Empty documents have no content
+        return [], []
+    return get_content_units(root)
+
+def extract_chapter_title(content, default_title):
     """
-    Extracts the chapter title from the EpubHtml item by parsing the content
-    and looking for heading tags or the <title> tag.
+    Extracts the chapter title from the raw HTML content of an EpubHtml item by
+    scanning for heading tags or the <title> tag.
     """
-    soup = BeautifulSoup(item.get_content(), 'html.parser')
     # Try to find the first <h1>, <h2>, <h3>, or <title> tag
-    title_tag = soup.find(['h1', 'h2', 'h3', 'title'])
-    if title_tag:
-        return title_tag.get_text().strip()
-    else:
-        # Fallback to the item's file name if no title is found
-        return item.get_name()
+    match = TITLE_RE.search(content)
+    title = ''
+    if match and match.group(2):
+        # Keep the text of the tag, without nested markup
+        title = html.unescape(TAG_RE.sub('', match.group(2).decode('utf-8', 'replace'))).strip()
+    # Fallback to the item's file name if no title is found
+    return title or default_title
+
+def get_toc_titles(toc):
+    """
+    Maps the file name of each document in the table of contents to the title of its first entry.
+    Hrefs are taken as relative to the package document, as item names are; a table of contents
+    stored in another directory will not match, and those chapters fall back to their headings.
+    """
+    toc_titles = {}
+
+    def process_entries(entries):
+        """Add the titles of the entries and of their nested sections."""
+        for entry in entries:
+            # Sections come as (Section, children) tuples, links on their own
+            children = ()
+            if isinstance(entry, tuple):
+                entry, children = entry
+            # Entries can point into a document; the title belongs to the document itself
+            # and is named without the percent-encoding the href may use
+            file_name = urllib.parse.unquote((getattr(entry, 'href', None) or '').split('#')[0])
+            title = (entry.title or '').strip()
+            if file_name and title:
+                toc_titles.setdefault(file_name, title)
+            process_entries(children)
+
+    process_entries(toc)
+    return toc_titles
+
+@st.cache_resource(max_entries=4, show_spinner=False)
+def load_book(epub_bytes):
+    """
+    Reads the EPUB file and returns the titles and the document items of its chapters.
+    """
+    # Load the EPUB file straight from the uploaded bytes
+    book = epub.read_epub(io.BytesIO(epub_bytes))
+    # Titles from the table of contents, when the book has one
+    toc_titles = get_toc_titles(book.toc)
+
+    # Initialize the chapter content
+    chapter_titles = []
+    seen_titles = set()
+    chapter_items = []
+    for item in book.get_items_of_type(ebooklib.ITEM_DOCUMENT):
+        # Use the chapter's title from the table of contents; only chapters missing from it
+        # have their content generated here, the others when they are opened
+        title = toc_titles.get(item.get_name()) or extract_chapter_title(item.get_content(), item.get_name())
+        # Number repeated titles so that chapters sharing a title can be told apart
+        base_title, count = title, 2
+        while title in seen_titles:
+            title = f"{base_title} ({count})"
+            count += 1
+        seen_titles.add(title)
+        chapter_items.append(item)
+        chapter_titles.append(title)
+
+    return chapter_titles, chapter_items
+
+@st.cache_resource(show_spinner=False)
+def get_prefetch_executor():
+    """
+    Returns the thread pool that parses the chapters next to the current one in the background.
+    """
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix='prefetch')
+
+def log_prefetch_failure(future):
+    """
+    Done callback that logs the error of a failed background chapter parse.
+    """
+    if not future.cancelled() and future.exception() is not None:
+        logger.warning("Could not prefetch chapter", exc_info=future.exception())
+
+def split_sentences(text):
+    """
+    Splits paragraph text into sentences.
+    """
+    return SENTENCE_BOUNDARY_RE.split(text)
 
-def get_display_content(paragraph_index, content_units):
+def get_display_content(paragraph_index, content_units, paragraph_indices):
     """
     Given the current paragraph index, return the content units to display.
     Includes the headings associated with each paragraph, and ensures three paragraphs are displayed.
     """
-    # Build a list of indices of paragraphs
-    paragraph_indices = [i for i, cu in enumerate(content_units) if cu['type'] == 'paragraph']
-
     num_paragraphs = len(paragraph_indices)
 
     # Handle the case where no paragraphs are found
@@ -130,8 +388,8 @@ def get_display_content(paragraph_index, content_units):
         idx = paragraph_pos - 1
         # Collect headings in reverse order until we hit a non-heading element
         headings = []
-        while idx >= 0 and content_units[idx]['type'] in ['heading', 'image', 'caption', 'spacer']:
-            if content_units[idx]['type'] == 'heading':
+        while idx >= 0 and content_units[idx].type in LEADING_UNIT_TYPES:
+            if content_units[idx].type == 'heading':
                 headings.insert(0, content_units[idx])  # Insert at the beginning
             idx -= 1
 
@@ -143,168 +401,125 @@ def get_display_content(paragraph_index, content_units):
 
         # Collect any non-paragraph content units immediately after the paragraph
         idx = paragraph_pos + 1
-        while idx < len(content_units) and content_units[idx]['type'] not in ['paragraph', 'heading']:
-            if content_units[idx]['type'] != 'spacer':
+        while idx < len(content_units) and content_units[idx].type not in SECTION_UNIT_TYPES:
+            if content_units[idx].type != 'spacer':
                 display_units.append(content_units[idx])
             idx += 1
 
     return display_units, paragraph_index
 
-def display_paragraphs(display_units, paragraph_index, content_units):
+def render_paragraphs(display_units, paragraph_index, content_units, paragraph_indices):
     """
-    Displays the content units, highlighting the current paragraph.
+    Builds the HTML for the content units, highlighting the current paragraph.
     """
-    # Build a list of indices of paragraphs
-    paragraph_indices = [i for i, cu in enumerate(content_units) if cu['type'] == 'paragraph']
-
-    # Handle the case where no paragraphs are found
-    if not paragraph_indices:
-        st.warning("No paragraphs found in this chapter.")
-        return
-
-    curr_para_pos = paragraph_indices[paragraph_index]
+    current_unit = content_units[paragraph_indices[paragraph_index]]
 
     # Prepare the HTML content
-    html_content = ""
+    html_parts = []
 
     for cu in display_units:
-        content_type = cu['type']
-        content_html = cu['content']
-        font_style = """
-            font-family: Georgia, serif;
-            font-weight: 450;
-            font-size: 20px;
-            color: var(--text-color);
-            line-height: 1.6;
-            max-width: 1000px;
-            margin: 10px auto;
-            padding: 15px;
-            border: 1px solid var(--primary-color);
-            transition: text-shadow 0.5s;
-        """
+        content_type = cu.type
         if content_type == 'heading':
             # Apply heading styles
-            heading_style = font_style + "font-size: 28px; font-weight: bold; border: none; padding-top: 30px;"
-            html_content += f"<div style='{heading_style}'>{content_html}</div>"
+            html_parts.append(f"<div class='reader-block reader-heading'>{unit_html(cu)}</div>")
         elif content_type == 'paragraph':
-            # Determine if this is the current paragraph to highlight
-            if cu == content_units[curr_para_pos]:
-                # Highlight the paragraph
-                soup = BeautifulSoup(content_html, 'html.parser')
-
-                # Handle any lists within the paragraph
-                lists = soup.find_all(['ul', 'ol'])
-                for lst in lists:
-                    # Replace lists with placeholders to prevent splitting sentences within lists
-                    placeholder = f"__LIST_PLACEHOLDER_{id(lst)}__"
-                    lst.replace_with(placeholder)
-
-                paragraph_text = soup.get_text()
-                sentences = sent_tokenize(paragraph_text.strip())
-                highlighted_sentences = []
-                for j, sentence in enumerate(sentences):
-                    # Replace placeholders back with the list HTML
-                    if "__LIST_PLACEHOLDER_" in sentence:
-                        for lst in lists:
-                            placeholder = f"__LIST_PLACEHOLDER_{id(lst)}__"
-                            if placeholder in sentence:
-                                sentence = sentence.replace(placeholder, str(lst))
-                    color_variable = f"var(--color-{j%5 +1})"
-                    highlighted_style = f"""
-                        background-color: {color_variable};
-                        padding: 2px 5px;
-                        border-radius: 5px;
-                        color: var(--text-color);
-                    """
-                    if sentence.strip():
-                        sentence_html = f'<span style="{highlighted_style}">{sentence.strip()}</span>'
-                        highlighted_sentences.append(sentence_html)
-                paragraph_content = ' '.join(highlighted_sentences)
-
-                # Re-insert any lists that were outside of sentences
-                if "__LIST_PLACEHOLDER_" in paragraph_content:
-                    for lst in lists:
-                        placeholder = f"__LIST_PLACEHOLDER_{id(lst)}__"
-                        if placeholder in paragraph_content:
-                            paragraph_content = paragraph_content.replace(placeholder, str(lst))
-
-                html_content += f"<div style='{font_style}'>{paragraph_content}</div>"
+            # Determine if this is the current paragraph to highlight; the display units are
+            # the chapter's own objects, so identity is enough
+            if cu is current_unit:
+                # Highlight the paragraph, escaping its plain text so that '<' and '&' stay literal
+                sentences = split_sentences(cu.text)
+                if len(sentences) == 1:
+                    # Single sentence, e.g. a line of dialogue; the paragraph text is already stripped
+                    paragraph_content = SENTENCE_TEMPLATE.format(cls=HIGHLIGHT_CLASSES[0], text=html.escape(cu.text))
+                else:
+                    paragraph_content = ' '.join(
+                        SENTENCE_TEMPLATE.format(cls=cls, text=html.escape(sentence.strip()))
+                        for cls, sentence in zip(itertools.cycle(HIGHLIGHT_CLASSES), sentences)
+                        if sentence.strip()
+                    )
+
+                html_parts.append(f"<div class='reader-block'>{paragraph_content}</div>")
             else:
                 # Regular paragraph style
-                html_content += f"<div style='{font_style}'>{content_html}</div>"
+                html_parts.append(f"<div class='reader-block'>{unit_html(cu)}</div>")
         elif content_type == 'caption':
             # Apply caption style
-            caption_style = font_style + "font-size: 18px; font-style: italic; border: none;"
-            html_content += f"<div style='{caption_style}'>{content_html}</div>"
+            html_parts.append(f"<div class='reader-block reader-caption'>{unit_html(cu)}</div>")
         elif content_type == 'image':
             # Apply image style
-            image_style = "display: flex; justify-content: center; margin: 20px 0;"
-            html_content += f"<div style='{image_style}'>{content_html}</div>"
+            html_parts.append(f"<div class='reader-image'>{unit_html(cu)}</div>")
         elif content_type == 'list':
             # Apply list style
-            list_style = font_style + "padding-left: 40px; list-style-type: disc; border: none;"
             # Ensure list tags are wrapped in a <div> with the style
-            html_content += f"<div style='{list_style}'>{content_html}</div>"
+            html_parts.append(f"<div class='reader-block reader-list'>{unit_html(cu)}</div>")
         elif content_type == 'spacer':
             # Skip spacers or add appropriate spacing if needed
             pass
         else:
             # Default style for other content
-            html_content += f"<div style='{font_style}'>{content_html}</div>"
+            html_parts.append(f"<div class='reader-block'>{unit_html(cu)}</div>")
 
-    # Display the HTML content using Streamlit
-    st.write(html_content, unsafe_allow_html=True)
+    return ''.join(html_parts)
 
-def main():
-    # Inject CSS styles
-    st.markdown("""
-    <style>
-    :root {
-        /* Dark theme colors */
-        --color-1: #d32f2f;
-        --color-2: #1976d2;
-        --color-3: #388e3c;
-        --color-4: #512da8;
-        --color-5: #FBC02D;
-        --text-color: #FFFFFF;
-        --primary-color: #0E1117;
-    }
+@st.cache_data(max_entries=256, show_spinner=False)
+def render_display_html(book_id, chapter_index, paragraph_index, _content_units, _paragraph_indices):
+    """
+    Returns the HTML for the paragraphs displayed around the given paragraph index.
+    The content units are left unhashed, since the book and chapter determine them.
+    """
+    display_units, paragraph_index = get_display_content(paragraph_index, _content_units, _paragraph_indices)
+    return render_paragraphs(display_units, paragraph_index, _content_units, _paragraph_indices)
 
-    @media (prefers-color-scheme: light) {
-        :root {
-            /* Light theme colors */
-            --color-1: #ffd54f;
-            --color-2: #aed581;
-            --color-3: #64b5f6;
-            --color-4: #f06292;
-            --color-5: #FBC02D;
-            --text-color: #000000;
-            --primary-color: #FFFFFF;
-        }
-    }
+def get_query_int(name):
+    """
+    Returns the non-negative integer stored in the given query parameter,
+    or 0 when it is missing or malformed.
+    """
+    try:
+        return max(int(st.query_params.get(name, 0)), 0)
+    except ValueError:
+        return 0
 
-    /* Hide the Streamlit style elements (hamburger menu, header, footer) */
-    
-    header {visibility: hidden;}
-    footer {visibility: hidden;}
+def move_paragraph(step, num_paragraphs):
+    """
+    Button callback that moves the reading position in the URL by the given step,
+    keeping it within the chapter.
+    """
+    last_paragraph = max(num_paragraphs - 1, 0)
+    st.query_params['p'] = str(min(max(get_query_int('p') + step, 0), last_paragraph))
 
-    /* Responsive font sizes for mobile devices */
-    @media only screen and (max-width: 600px) {
-        div[style] {
-            font-size: 5vw !important;
-        }
-    }
+@st.fragment
+def reader(book_id, chapter_index, content_units, paragraph_indices):
+    """
+    Displays the navigation buttons and the paragraphs around the current one.
+    Runs as a fragment so that Previous/Next only rerun this function, not the whole script.
+    """
+    # Display navigation buttons; their callbacks move the position before the fragment reruns
+    col1, col2, col3 = st.columns([1, 1, 1])
+    with col1:
+        st.button("Previous", on_click=move_paragraph, args=(-1, len(paragraph_indices)))
+    with col3:
+        st.button("Next", on_click=move_paragraph, args=(1, len(paragraph_indices)))
+
+    # Read the current paragraph from the URL, keeping it within the chapter
+    current_paragraph = min(get_query_int('p'), max(len(paragraph_indices) - 1, 0))
+    if st.query_params.get('p') != str(current_paragraph):
+        st.query_params['p'] = str(current_paragraph)
 
-    ul, ol {
-        margin: 0;
-        padding-left: 1.5em;
-    }
+    # Handle the case where no paragraphs are found
+    if not paragraph_indices:
+        st.warning("No paragraphs found in this chapter.")
+        return
 
-    li {
-        margin-bottom: 0.5em;
-    }
-    </style>
-    """, unsafe_allow_html=True)
+    # Display the content units
+    html_content = render_display_html(
+        book_id, chapter_index, current_paragraph, content_units, paragraph_indices
+    )
+    st.write(html_content, unsafe_allow_html=True)
+
+def main():
+    # Inject CSS styles
+    st.markdown(READER_CSS, unsafe_allow_html=True)
 
     st.title("EPUB Reader")
 
@@ -312,66 +527,55 @@ def main():
     uploaded_file = st.sidebar.file_uploader("Choose an EPUB file", type="epub")
 
     if uploaded_file is not None:
-        # Create a temporary file to store the EPUB file
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.epub') as tmp_file:
-            tmp_file.write(uploaded_file.getvalue())
-            tmp_file_path = tmp_file.name
-
         try:
-            # Load the EPUB file from the temporary file path
-            book = epub.read_epub(tmp_file_path)
+            # Load the chapters of the EPUB file
+            chapter_titles, chapter_items = load_book(uploaded_file.getvalue())
         except Exception as e:
             st.error(f"An error occurred while reading the EPUB file: {e}")
             return
-        finally:
-            # Clean up the temporary file
-            os.remove(tmp_file_path)
-
-        # Initialize the chapter content
-        chapters = []
-        chapter_titles = []
-        for item in book.get_items():
-            if item.get_type() == ebooklib.ITEM_DOCUMENT:
-                chapters.append(item)
-                # Extract chapter title
-                title = extract_chapter_title(item)
-                chapter_titles.append(title)
-
-        if chapters:
+
+        if chapter_items:
+            # The position in the URL belongs to the first book opened; another book starts at the top
+            if st.session_state.get('book_id') != uploaded_file.file_id:
+                if 'book_id' in st.session_state:
+                    st.session_state['initial_chapter'] = 0
+                    st.query_params['chapter'] = '0'
+                    st.query_params['p'] = '0'
+                st.session_state['book_id'] = uploaded_file.file_id
+
             # Move chapter selector to sidebar
-            selected_chapter = st.sidebar.selectbox("Select a chapter", chapter_titles)
-            chapter_index = chapter_titles.index(selected_chapter)
-            selected_item = chapters[chapter_index]
-
-            # Parse the HTML content of the chapter
-            soup = BeautifulSoup(selected_item.get_content(), 'html.parser')
-            # Use the get_content_units function to get content units
-            content_units = get_content_units(soup)
-
-            # Build a list of indices of paragraphs
-            paragraph_indices = [i for i, cu in enumerate(content_units) if cu['type'] == 'paragraph']
-
-            # Initialize session state for the paragraph index
-            if 'current_paragraph' not in st.session_state or st.session_state.chapter != selected_chapter:
-                st.session_state.current_paragraph = 0
-                st.session_state.chapter = selected_chapter  # Keep track of selected chapter
-
-            # Display navigation buttons
-            col1, col2, col3 = st.columns([1, 1, 1])
-            with col1:
-                if st.button("Previous"):
-                    if st.session_state.current_paragraph > 0:
-                        st.session_state.current_paragraph -= 1
-            with col3:
-                if st.button("Next"):
-                    if st.session_state.current_paragraph + 1 < len(paragraph_indices):
-                        st.session_state.current_paragraph += 1
-
-            # Get the display content units
-            display_units, para_idx = get_display_content(st.session_state.current_paragraph, content_units)
-
-            # Display the content units
-            display_paragraphs(display_units, st.session_state.current_paragraph, content_units)
+            # Start on the chapter from the URL, read once so the selectbox keeps a stable default
+            initial_chapter = st.session_state.setdefault('initial_chapter', get_query_int('chapter'))
+            # Select by position so that the chosen chapter needs no lookup by title;
+            # keyed on the book so that a new book does not inherit the previous selection
+            chapter_index = st.sidebar.selectbox(
+                "Select a chapter", range(len(chapter_titles)),
+                index=min(initial_chapter, len(chapter_titles) - 1),
+                format_func=lambda i: chapter_titles[i],
+                key=f"chapter_{uploaded_file.file_id}",
+            )
+
+            # Parse the HTML content of the chapter into content units
+            content_units, paragraph_indices = parse_chapter(
+                uploaded_file.file_id, chapter_index, chapter_items[chapter_index]
+            )
+
+            # Parse the neighbouring chapters in the background so that moving to them is instant
+            executor = get_prefetch_executor()
+            for neighbour_index in (chapter_index - 1, chapter_index + 1):
+                if 0 <= neighbour_index < len(chapter_items):
+                    future = executor.submit(
+                        parse_chapter, uploaded_file.file_id, neighbour_index, chapter_items[neighbour_index]
+                    )
+                    future.add_done_callback(log_prefetch_failure)
+
+            # Keep the reading position in the URL so it survives reloads; new chapters start at the top
+            if st.query_params.get('chapter') != str(chapter_index):
+                st.query_params['chapter'] = str(chapter_index)
+                st.query_params['p'] = '0'
+
+            # Display the navigation buttons and paragraphs
+            reader(uploaded_file.file_id, chapter_index, content_units, paragraph_indices)
         else:
             st.error("No readable content found in the EPUB file.")
             return